@@ -1,13 +1,78 @@
+import os
+import asyncio
+import selectors
+import queue
 import socket
-import socketserver
 import logging
+import logging.handlers
+import traceback
 
 
-class ThreadingTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
-    pass
+def _new_event_loop():
+    """
+    Create the event loop for the service, backed by epoll where available.
+    """
+    selector_cls = getattr(selectors, 'EpollSelector', selectors.DefaultSelector)
+    return asyncio.SelectorEventLoop(selector_cls())
+
+
+async def _serve(host, port, service, handler, reuse_port):
+    server = await asyncio.start_server(handler.handle_client, host, port, reuse_port=reuse_port)
+    # add the server to the service to call finish after all requests are processed
+    service.server = server
+    try:
+        await service.run()
+    finally:
+        server.close()
+    # let the requests that are still in flight finish before the loop is torn down
+    await handler.wait_closed()
+
+
+def _start_log_listener():
+    """
+    Put the handlers of the root logger behind a queue that is emptied by a background thread,
+    so that logging from the event loop does not block on I/O.
+    Returns the listener and the original handlers.
+    """
+    root = logging.getLogger()
+    handlers = root.handlers[:]
+    if not handlers:
+        return None, handlers
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    root.handlers = [logging.handlers.QueueHandler(log_queue)]
+    listener.start()
+    return listener, handlers
+
+
+def _stop_log_listener(listener, handlers):
+    """
+    Restore the original handlers of the root logger and process the remaining log records.
+    """
+    if listener is None:
+        return
+    logging.getLogger().handlers = handlers
+    listener.stop()
 
 
-def start_service(host, port, service, request_handler):
+def _run_service(host, port, service, request_handler, reuse_port=False):
+    # all connections are served from a single event loop instead of one thread per connection
+    # wrap in a try except and serialize the current state on keyboard interrupt
+    listener, handlers = _start_log_listener()
+    try:
+        with asyncio.Runner(loop_factory=_new_event_loop) as runner:
+            runner.run(_serve(host, port, service, request_handler(service), reuse_port))
+    except KeyboardInterrupt as e:
+        service.serialize_status(True)
+        service.server_is_running = False
+        raise e
+    except Exception as e:
+        raise e
+    finally:
+        _stop_log_listener(listener, handlers)
+
+
+def start_service(host, port, service, request_handler, num_processes=1):
     """
     Start a service.
     ----------------
@@ -15,50 +80,133 @@ def start_service(host, port, service, request_handler):
     port [int]: port for the TCP-Server
     service: service run by the TCP-Server, must subclass `BaseService`
     request_handler: request handler for the TCP-Server, must subclass `BaseRequestHandler`
+    num_processes [int]: number of processes serving on the port, if larger than 1,
+        each process serves its own partition of the service and the kernel balances
+        the incoming connections between them (SO_REUSEPORT); None uses all cpus (default: 1)
     """
     assert isinstance(service, BaseService)
-    server = ThreadingTCPServer((host, port), request_handler)
-    # add the service to the server to access it for requests
-    server.service = service
-    # add the server to the service to call finish after all requests are processed
-    service.server = server
-    # wrap in a try except and serialize the current state on keyboard interrupt
+    assert issubclass(request_handler, BaseRequestHandler)
+    if num_processes is None:
+        num_processes = os.cpu_count()
+    if num_processes == 1:
+        _run_service(host, port, service, request_handler)
+        return
+
+    # fork the processes before any event loop is created
+    pids = []
+    for index in range(num_processes):
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 0
+            try:
+                service.partition(index, num_processes)
+                _run_service(host, port, service, request_handler, reuse_port=True)
+            except KeyboardInterrupt:
+                exit_code = 1
+            except BaseException:
+                traceback.print_exc()
+                exit_code = 1
+            finally:
+                os._exit(exit_code)
+        pids.append(pid)
+
+    # wait for all processes to finish, they handle keyboard interrupts themselves
+    exit_codes = []
     try:
-        server.serve_forever()
+        for pid in pids:
+            exit_codes.append(os.waitstatus_to_exitcode(os.waitpid(pid, 0)[1]))
     except KeyboardInterrupt as e:
-        service.serialize_status(True)
-        service.shutdown_server()
-        raise e
-    except Exception as e:
+        for pid in pids:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
         raise e
 
+    failed = [index for index, exit_code in enumerate(exit_codes) if exit_code != 0]
+    if failed:
+        raise RuntimeError("Service processes %s exited with an error" % failed)
 
-class BaseRequestHandler(socketserver.StreamRequestHandler):
+
+class BaseRequestHandler(object):
     """
     Base class for request handler.
     Must override `format_request` and `format_response`.
     """
+    def __init__(self, service):
+        self.service = service
+        # open connections (handler task -> writer) and the requests that are currently processed,
+        # each one is a future that is done once its response is written
+        self._connections = {}
+        self._busy = set()
+
+    async def read_request(self, reader):
+        """
+        Read the next request from the connection.
+        Must return bytes, empty if the connection was closed.
+        Default implementation reads one line.
+        """
+        return await reader.readline()
+
     def format_request(self, request):
         """
         Format the client-side request.
-        Must return string.
+        Gets the bytes returned by `read_request`.
         """
         raise AttributeError("BaseRequestHandler does not implement format_request")
 
     def format_response(self, response):
         """
         Format the client-side response.
-        Must return string.
+        Must return bytes, or a list of bytes that are sent together.
         """
         raise AttributeError("BaseRequestHandler does not implement format_response")
 
-    def handle(self):
+    async def handle_client(self, reader, writer):
         """
-        Handle request.
+        Handle all requests sent over a client connection.
         """
-        request = self.format_request(self.rfile.readline().strip())
-        response = self.format_response(self.server.service.process_request(request))
-        self.wfile.write(bytes(response + "\n", "utf8"))
+        task = asyncio.current_task()
+        self._connections[task] = writer
+        try:
+            while True:
+                message = await self.read_request(reader)
+                if not message:
+                    break
+                done = asyncio.get_running_loop().create_future()
+                self._busy.add(done)
+                try:
+                    request = self.format_request(message)
+                    response = self.format_response(await self.service.process_request(request))
+                    # a list of buffers is sent with a single write instead of joining them first
+                    if isinstance(response, list):
+                        writer.writelines(response)
+                    else:
+                        writer.write(response)
+                    await writer.drain()
+                finally:
+                    self._busy.discard(done)
+                    done.set_result(None)
+                # don't wait for further requests once the service is shut down
+                if not self.service.server_is_running:
+                    break
+        except (ConnectionResetError, BrokenPipeError):
+            # the client has gone away
+            pass
+        finally:
+            writer.close()
+            del self._connections[task]
+
+    async def wait_closed(self):
+        """
+        Wait for the requests that are still being handled, then close all connections.
+        """
+        if self._busy:
+            await asyncio.wait(list(self._busy))
+        for writer in self._connections.values():
+            writer.close()
+        if self._connections:
+            await asyncio.wait(list(self._connections))
 
 
 class BaseService(object):
@@ -71,23 +219,40 @@ class BaseService(object):
         self.logger = logging.getLogger(__name__)
         self.server = None  # must be monkey-patched
         self.server_is_running = True
+        self._shutdown_event = asyncio.Event()
 
-    def process_request(self, request):
+    async def run(self):
+        """
+        Run the service until `shutdown_server` is called.
+        Can be extended to run background tasks next to the server.
+        """
+        await self._shutdown_event.wait()
+
+    async def process_request(self, request):
         """
         Process incoming request.
         """
         raise AttributeError("BaseService does not implement process request")
 
+    def partition(self, index, n_partitions):
+        """
+        Restrict the service to the part `index` of `n_partitions` disjoint parts.
+        Called in each process if the service is started with several processes.
+        """
+        raise AttributeError("BaseService does not implement partition")
+
     def shutdown_server(self):
         """
         Shutdown the server after all requests are processed.
         """
         if self.server is None:
             raise RuntimeError("Cannot call shutdown; invalid server")
-        self.logger.info(" Shutting down connection to server %s:%i" % self.server.server_address)
-        self.server.shutdown()
-        self.server.server_close()
+        if self.server.sockets:
+            self.logger.info(" Shutting down connection to server %s:%i" %
+                             self.server.sockets[0].getsockname()[:2])
+        self.server.close()
         self.server_is_running = False
+        self._shutdown_event.set()
 
     def serialize_status(self, from_interrupt=False):
         """
@@ -105,25 +270,94 @@ class BaseClient(object):
     Base client.
     Must override `format_request` and `format_response`.
     """
-    def __init__(self, host, port):
+    def __init__(self, host, port, buffer_size=1024):
         self.host = host
         self.port = port
+        # the connection is opened on the first request and kept open for the following ones
+        self._sock = None
+        # whether a connection to the server was established at some point
+        self._was_connected = False
+        # responses are received into the same buffer for all requests
+        self._recv_buf = bytearray(buffer_size)
+        self._recv_view = memoryview(self._recv_buf)
 
     def format_request(self, request):
         """
         Format incoming request.
-        Must return string.
+        Must return bytes.
         """
         raise AttributeError("BaseClient does not implement format request")
 
+    def receive(self, start, stop):
+        """
+        Receive `stop - start` bytes from the server into the receive buffer at `start`.
+        Returns a view of the buffer up to `stop`, which is only valid until the next request.
+        """
+        if stop > len(self._recv_buf):
+            # grow the buffer for large responses, keeping what was received so far
+            buf = bytearray(stop)
+            buf[:start] = self._recv_buf[:start]
+            self._recv_buf, self._recv_view = buf, memoryview(buf)
+        view = self._recv_view
+        while start < stop:
+            n_received = self._sock.recv_into(view[start:stop])
+            if n_received == 0:
+                raise ConnectionResetError("Connection closed by server")
+            start += n_received
+        return view[:stop]
+
+    def read_response(self):
+        """
+        Read the response from the connection, using `receive`.
+        Default implementation reads one line.
+        """
+        view = self._recv_view
+        n = 0
+        while not n or view[n - 1] != ord('\n'):
+            if n == len(view):
+                raise RuntimeError("Response exceeds the receive buffer")
+            n_received = self._sock.recv_into(view[n:])
+            if n_received == 0:
+                raise ConnectionResetError("Connection closed by server")
+            n += n_received
+        return view[:n]
+
     def format_response(self, response):
         """
         Format incoming response.
+        Gets the buffer view returned by `read_response`.
         """
         raise AttributeError("BaseClient does not implement format response")
 
+    def connect(self):
+        """
+        Open the connection to the server.
+        """
+        self._sock = socket.create_connection((self.host, self.port))
+        self._was_connected = True
+        # requests and responses are tiny, so don't let Nagle's algorithm delay them
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def close(self):
+        """
+        Close the connection to the server.
+        """
+        if self._sock is not None:
+            self._sock.close()
+        self._sock = None
+
+    def _send(self, message):
+        if self._sock is None:
+            self.connect()
+        self._sock.sendall(message)
+        return self.read_response()
+
     def request(self, request=None):
-        with socket.create_connection((self.host, self.port)) as sock:
-            sock.sendall(bytes(self.format_request(request) + '\n', 'utf-8'))
-            response = self.format_response(str(sock.recv(1024), 'utf-8'))
-        return response
+        message = self.format_request(request)
+        try:
+            response = self._send(message)
+        except (ConnectionResetError, BrokenPipeError):
+            # the server has dropped the connection, reconnect and try once more
+            self.close()
+            response = self._send(message)
+        return self.format_response(response)
@@ -1,45 +1,109 @@
 import os
 import json
-import threading
 import time
-from collections import deque
+import asyncio
+import struct
+import logging
+
+import numpy as np
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 from ..base import BaseRequestHandler, BaseService, BaseClient
+from .dispatch import BlockDispatcher, IN_PROGRESS, DONE, FAILED
+
+# requests and responses are sent as binary frames with a header of an opcode / status and a count,
+# followed by `count` block offsets (3 x int32) for OP_CONFIRM requests and STATUS_BLOCK responses.
+# OP_REQUEST asks for up to `count` blocks, STATUS_SUCCESS / STATUS_FAILURE report
+# whether all blocks were confirmed
+HEADER = struct.Struct("<BI")
+OFFSETS_DTYPE = np.dtype('<i4')
+OFFSETS_SIZE = 3 * OFFSETS_DTYPE.itemsize
+OP_REQUEST, OP_CONFIRM = 1, 2
+STATUS_SUCCESS, STATUS_FAILURE, STATUS_STOP, STATUS_BLOCK = 0, 1, 2, 3
+# maximal count of a frame, so that a bad header can't make the service buffer gigabytes
+MAX_BLOCKS_PER_FRAME = 4096
+# the frames that don't carry offsets never change, so they are only packed once
+_REQUEST_FRAME = HEADER.pack(OP_REQUEST, 1)
+_SUCCESS_FRAME = HEADER.pack(STATUS_SUCCESS, 0)
+_FAILURE_FRAME = HEADER.pack(STATUS_FAILURE, 0)
+_STOP_FRAME = HEADER.pack(STATUS_STOP, 0)
+# the client side return values of the status-only responses
+_STATUS_RESPONSES = {STATUS_SUCCESS: True, STATUS_FAILURE: False, STATUS_STOP: None}
+
+
+def pack_offsets(block_offsets):
+    return np.asarray(block_offsets, dtype=OFFSETS_DTYPE).tobytes()
+
+
+def unpack_offsets(buffer):
+    return np.frombuffer(buffer, dtype=OFFSETS_DTYPE, offset=HEADER.size).reshape(-1, 3).tolist()
+
+
+def load_block_list(block_file):
+    """
+    Load the block offsets from a json file (list of offsets)
+    or a npy file (int array of shape N x 3) into an array of shape N x 3.
+    The npy file is memory-mapped instead of being read.
+    """
+    if os.path.splitext(block_file)[1] == '.npy':
+        return np.load(block_file, mmap_mode='r').reshape(-1, 3)
+    with open(block_file, 'rb') as f:
+        data = f.read()
+    block_list = json.loads(data) if orjson is None else orjson.loads(data)
+    return np.array(block_list, dtype='int32').reshape(-1, 3)
 
 
 class BlockRequestHandler(BaseRequestHandler):
     """
     BlockRequestHandler
     """
+    async def read_request(self, reader):
+        """
+        Read the next request frame.
+        """
+        try:
+            header = await reader.readexactly(HEADER.size)
+            op, count = HEADER.unpack(header)
+            # frames with an invalid count are rejected by `format_request` without reading the offsets
+            if op == OP_CONFIRM and count <= MAX_BLOCKS_PER_FRAME:
+                return header + await reader.readexactly(count * OFFSETS_SIZE)
+            return header
+        except asyncio.IncompleteReadError:
+            return b''
+
     def format_request(self, request):
         """
-        Format the request: single word will result in requesting a new block,
-        3 words will confirm this block
-        """
-        request = request.split()
-        # if we have a length of 1, a new block is requested, otherwise a block is confirmed
-        if len(request) == 1:
-            return None
-        elif len(request) == 3:
-            if not all(reg.isdigit() for reg in request):
-                raise RuntimeError("Invalid block request")
-            return [int(req) for req in request]
+        Format the request: OP_REQUEST will result in requesting `count` new blocks,
+        OP_CONFIRM will confirm the blocks with the offsets in the frame
+        """
+        op, count = HEADER.unpack_from(request)
+        # an empty request would look like an exhausted queue and stop the service
+        if not 1 <= count <= MAX_BLOCKS_PER_FRAME:
+            raise RuntimeError("Invalid block request")
+        if op == OP_REQUEST:
+            return count
+        elif op == OP_CONFIRM:
+            return unpack_offsets(request)
         else:
             raise RuntimeError("Invalid block request")
 
     def format_response(self, response):
         """
-        Format the response: return 0 or 1 for a confirmation request,
-        return the block offsets for a block request,
-        return "stop" if all requests are processed (None)
+        Format the response: return STATUS_SUCCESS or STATUS_FAILURE for a confirmation request,
+        return STATUS_BLOCK and the block offsets for a block request,
+        return STATUS_STOP if all requests are processed (None)
         """
-        if isinstance(response, bool):
-            response = "0" if response else "1"
+        if response is True:
+            response = _SUCCESS_FRAME
+        elif response is False:
+            response = _FAILURE_FRAME
         elif isinstance(response, list):
-            assert len(response) == 3
-            response = " ".join(map(str, response))
+            response = [HEADER.pack(STATUS_BLOCK, len(response)), pack_offsets(response)]
         elif response is None:
-            response = "stop"
+            response = _STOP_FRAME
         else:
             raise RuntimeError("Invalid response")
         return response
@@ -77,125 +141,136 @@ class BlockService(BaseService):
         else:
             self.logger.warn(" Will not serialize failed blocks, you can serialize them by passing argument `out_prefix`")
 
-        # load the coordinates of the blocks that will be processed
-        # make a queue containing all block offsets
+        # load the coordinates of the blocks that will be processed,
+        # the dispatcher keeps track of pending, in-progress, processed and failed blocks
         assert os.path.exists(block_file), block_file
-        with open(block_file, 'r') as f:
-            self.block_queue = deque(reversed(json.load(f)))
+        self.dispatcher = BlockDispatcher(load_block_list(block_file), time_limit)
         self.logger.info(" Loaded block list from: %s" % block_file)
-        self.logger.info(" Added %i blocks to queue" % len(self.block_queue))
-
-        # list to keep track of ids that are currently processed
-        self.in_progress = []
-        self.time_stamps = []
-        # list of offsets that have been processed
-        self.processed_list = []
-        # list of failed blocks
-        self.failed_blocks = []
-        self.lock = threading.Lock()
-
-        # start the background thread that checks for failed jobs
-        self.bg_thread = threading.Thread(target=self.check_progress_list, args=())
-        self.bg_thread.daemon = True
-        self.bg_thread.start()
-
-    def process_request(self, request):
-        self.logger.debug(" Process incomig request: %s" % str(request))
-        # request a new block
-        if request is None:
-            return self.request_block()
-        # confirm a block
+        self.logger.info(" Added %i blocks to queue" % len(self.dispatcher.blocks))
+
+        # NOTE all requests are handled in the same event loop and the dispatcher is only accessed
+        # in between awaits, so there is no lock; waiting is done with events instead of conditions
+        # set when blocks are handed out while none were in progress,
+        # so that the time limit check can wake up
+        self.deadline_event = asyncio.Event()
+        # set when the last block in progress is finished (or cancelled) and when failed blocks
+        # are queued again, so that requests waiting for blocks can continue
+        self.drain_event = asyncio.Event()
+
+    async def run(self):
+        # start the background task that checks for failed jobs
+        checker = asyncio.ensure_future(self.check_progress_list())
+        try:
+            await super(BlockService, self).run()
+        finally:
+            checker.cancel()
+
+    def partition(self, index, n_partitions):
+        """
+        Keep only every `n_partitions`-th block, starting at `index`.
+        """
+        self.dispatcher = BlockDispatcher(self.dispatcher.blocks[index::n_partitions], self.time_limit)
+        self.logger.info(" Partition %i / %i with %i blocks" % (index, n_partitions, len(self.dispatcher.blocks)))
+        # serialize the status of each partition separately
+        if self.out_prefix is not None:
+            self.out_prefix = "%spartition%i_" % (self.out_prefix, index)
+
+    async def process_request(self, request):
+        self.logger.debug(" Process incomig request: %s", request)
+        # request new blocks
+        if isinstance(request, int):
+            return await self.request_blocks(request)
+        # confirm blocks
         else:
-            return self.confirm_block(request)
+            return await self.confirm_blocks(request)
 
     # check the progress list for blocks that have exceeded the time limit
-    def check_progress_list(self):
+    async def check_progress_list(self):
         while self.server_is_running:
-            time.sleep(self.check_interval)
-            with self.lock:
-                now = time.time()
-                self.logger.debug(" Checking progress list for %i blocks" % len(self.time_stamps))
-                # find blocks that have exceeded the time limit
-                failed_block_ids = [ii for ii, time_stamp in enumerate(self.time_stamps)
-                                    if now - time_stamp > self.time_limit]
-                self.logger.info(" Found %i blocks over the time limit" % len(failed_block_ids))
-                # remove failed blocks and time stamps from in progress and
-                # append failed blocks to the failed list
-                # NOTE: we need to iterate in reverse order to delete the correct elements
-                for ii in sorted(failed_block_ids, reverse=True):
-                    del self.time_stamps[ii]
-                    self.failed_blocks.append(self.in_progress.pop(ii))
-
-    # request the next block to be processed
+            # sleep until the earliest deadline is due, or until blocks are handed out
+            timeout = self.check_interval
+            next_deadline = self.dispatcher.next_deadline()
+            if next_deadline is not None:
+                timeout = min(timeout, (next_deadline - time.monotonic_ns()) / 1e9)
+            if timeout > 0:
+                try:
+                    await asyncio.wait_for(self.deadline_event.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                self.deadline_event.clear()
+
+            self.logger.debug(" Checking progress list for %i blocks", len(self.dispatcher.in_progress))
+            # move the blocks that have exceeded the time limit to the failed list
+            n_failed = self.dispatcher.sweep(time.monotonic_ns())
+            if n_failed:
+                self.logger.info(" Found %i blocks over the time limit", n_failed)
+                if not self.dispatcher.in_progress:
+                    self.notify_drain()
+
+    # wake up all requests that are waiting for blocks, later requests wait for a new event
+    def notify_drain(self):
+        self.drain_event.set()
+        self.drain_event = asyncio.Event()
+
+    # get up to `n_blocks` pending blocks and add them to the blocks in progress,
+    # returns an empty list if no blocks are pending
+    def pop_blocks(self, n_blocks):
+        # the new deadlines are later than the ones of the blocks in progress,
+        # so the time limit check only needs to be woken if there were none
+        was_idle = not self.dispatcher.in_progress
+        block_offsets = self.dispatcher.pop_blocks(n_blocks, time.monotonic_ns())
+        if block_offsets:
+            if was_idle:
+                self.deadline_event.set()
+            self.logger.debug(" Returning block offsets: %s", block_offsets)
+        return block_offsets
+
+    # request up to `n_blocks` blocks to be processed
     # if no more blocks are present, return None
-    def request_block(self):
-
-        # return a block offset if we still have blocks in the quee
-        if len(self.block_queue) > 0:
-            with self.lock:
-                block_offsets = self.block_queue.pop()
-                self.in_progress.append(block_offsets)
-                self.time_stamps.append(time.time())
-                self.logger.debug(" Returning block offsets: %s" % str(block_offsets))
-
-        # otherwise, wait for the ones in progress to finish (or be cancelled)
-        # then either repopulate, or exit
-        else:
+    async def request_blocks(self, n_blocks=1):
 
-            # NOTE this must not be locked, otherwise
-            # we end up with a deadlock with the lock in `check_progress_list`
-            while self.in_progress:
-                time.sleep(self.check_interval)
-                continue
-
-            with self.lock:
-                # we need to check again inf the block queue is empty, because it might have been repopulated
-                # in the meantime already
-                if len(self.block_queue) > 0:
-                    block_offsets = self.block_queue.pop()
-                    self.in_progress.append(block_offsets)
-                    self.time_stamps.append(time.time())
-                    self.logger.debug(" Returning block offsets: %s" % str(block_offsets))
-                elif self.try_counter < self.num_retries and self.failed_blocks:
-                    self.logger.info(" Exhausted block queue, repopulating for %i time" % self.try_counter)
-                    block_offsets = self.repopulate_queue()
-                    self.try_counter += 1
-                else:
-                    block_offsets = None
-                    if self.server_is_running:
-                        self.logger.info(" Exhausted block queue, shutting down service")
-                        self.serialize_status()
-                        self.shutdown_server()
+        # if we don't have blocks in the queue, wait for the ones in progress to finish (or be cancelled),
+        # unless the queue is repopulated in the meantime
+        while not self.dispatcher.has_pending() and self.dispatcher.in_progress:
+            await self.drain_event.wait()
+
+        # return block offsets if we have blocks in the queue, otherwise either repopulate, or exit
+        block_offsets = self.pop_blocks(n_blocks)
+        if not block_offsets:
+            if self.try_counter < self.num_retries and self.dispatcher.has_failed():
+                self.logger.info(" Exhausted block queue, repopulating for %i time" % self.try_counter)
+                block_offsets = self.repopulate_queue(n_blocks)
+                self.try_counter += 1
+            else:
+                block_offsets = None
+                if self.server_is_running:
+                    self.logger.info(" Exhausted block queue, shutting down service")
+                    self.serialize_status()
+                    self.shutdown_server()
         return block_offsets
 
-    # confirm that a block has been processed
-    def confirm_block(self, block_offset):
-        # see of the offset is still in the in-progress
-        # list and remove it.
+    # confirm that blocks have been processed
+    async def confirm_blocks(self, block_offsets):
+        # see of the offsets are still in progress and remove them.
         # if not, the time limit was exceeded and something is most likely wrong
         # with the block and the block was put on the failed block list
-        self.logger.debug(" Confirming block %s" % str(block_offset))
-        try:
-            with self.lock:
-                index = self.in_progress.index(block_offset)
-                del self.in_progress[index]
-                del self.time_stamps[index]
-                self.processed_list.append(block_offset)
-            success = True
-            self.logger.debug(" Block %s was processed properly." % str(block_offset))
-        except ValueError:
-            success = False
-            self.logger.debug(" Block %s is over time limit and was added to failed blocks" % str(block_offset))
-        return success
-
-    def repopulate_queue(self):
-        self.block_queue.extendleft(self.failed_blocks)
-        self.failed_blocks = []
-        block_offsets = self.block_queue.pop()
-        self.in_progress.append(block_offsets)
-        self.time_stamps.append(time.time())
-        self.logger.debug(" Returning block offsets: %s" % str(block_offsets))
-        return block_offsets
+        self.logger.debug(" Confirming blocks %s", block_offsets)
+        confirmed = [self.dispatcher.confirm(block_offset) for block_offset in block_offsets]
+        if not self.dispatcher.in_progress:
+            self.notify_drain()
+        if self.logger.isEnabledFor(logging.DEBUG):
+            for block_offset, success in zip(block_offsets, confirmed):
+                if success:
+                    self.logger.debug(" Block %s was processed properly.", block_offset)
+                else:
+                    self.logger.debug(" Block %s is over time limit and was added to failed blocks", block_offset)
+        return all(confirmed)
+
+    def repopulate_queue(self, n_blocks):
+        self.dispatcher.repopulate()
+        # let the other waiting requests take the remaining blocks
+        self.notify_drain()
+        return self.pop_blocks(n_blocks)
 
     def serialize_status(self, from_interrupt=False):
         """
@@ -206,27 +281,28 @@ class BlockService(BaseService):
         else:
             self.logger.info(" serialize_status called after regular shutdown")
 
+        # the blocks are saved as int arrays of shape N x 3, which can be used as block file again
         if self.out_prefix is not None:
-            if self.failed_blocks:
-                out_failed_blocks = self.out_prefix + "failed_blocks.json"
+            failed_blocks = self.dispatcher.get_blocks(FAILED)
+            if len(failed_blocks):
+                out_failed_blocks = self.out_prefix + "failed_blocks.npy"
                 self.logger.info(" Serialized list of failed blocks with %i entries to %s" %
-                                 (len(self.failed_blocks), out_failed_blocks))
-                with open(out_failed_blocks, 'w') as f:
-                    json.dump(self.failed_blocks, f)
+                                 (len(failed_blocks), out_failed_blocks))
+                np.save(out_failed_blocks, failed_blocks)
 
-            if self.processed_list:
-                out_processed_blocks = self.out_prefix + "processed_blocks.json"
+            processed_list = self.dispatcher.get_blocks(DONE)
+            if len(processed_list):
+                out_processed_blocks = self.out_prefix + "processed_blocks.npy"
                 self.logger.info(" Serialized list of processed blocks with %i entries to %s" %
-                                 (len(self.processed_list), out_processed_blocks))
-                with open(out_processed_blocks, 'w') as f:
-                    json.dump(self.processed_list, f)
+                                 (len(processed_list), out_processed_blocks))
+                np.save(out_processed_blocks, processed_list)
 
-            if self.in_progress:
-                out_in_progress = self.out_prefix + "inprogress_blocks.json"
+            in_progress = self.dispatcher.get_blocks(IN_PROGRESS)
+            if len(in_progress):
+                out_in_progress = self.out_prefix + "inprogress_blocks.npy"
                 self.logger.info(" Serialized list of in-progress blocks with %i entries to %s" %
-                                 (len(self.in_progress), out_in_progress))
-                with open(self.out_prefix + "inprogress_blocks.json", 'w') as f:
-                    json.dump(self.in_progress, f)
+                                 (len(in_progress), out_in_progress))
+                np.save(out_in_progress, in_progress)
 
 
 class BlockClient(BaseClient):
@@ -235,19 +311,67 @@ class BlockClient(BaseClient):
     def format_request(self, request):
         """
         Format incoming request.
-        Must return string.
+        Must return bytes.
+        """
+        # the number of blocks to request
+        if isinstance(request, int):
+            return _REQUEST_FRAME if request == 1 else HEADER.pack(OP_REQUEST, request)
+        # the offsets of the blocks to confirm
+        block_offsets = pack_offsets(request)
+        return HEADER.pack(OP_CONFIRM, len(block_offsets) // OFFSETS_SIZE) + block_offsets
+
+    def request(self, request=None, n_blocks=None):
         """
-        return "1" if request is None else " ".join(map(str, request))
+        Request a block if `request` is None, or up to `n_blocks` blocks if it is given.
+        Otherwise confirm the block with offsets `request`, or the list of block offsets `request`.
+        Returns the block offsets (a list of block offsets if `n_blocks` is given) or None if
+        all blocks are processed, respectively whether all blocks were confirmed.
+        """
+        if request is not None:
+            if not isinstance(request[0], (list, tuple)):
+                request = [request]
+            if len(request) > MAX_BLOCKS_PER_FRAME:
+                raise RuntimeError("Can't confirm more than %i blocks at once" % MAX_BLOCKS_PER_FRAME)
+            return super(BlockClient, self).request(request)
+
+        if n_blocks is not None and not 1 <= n_blocks <= MAX_BLOCKS_PER_FRAME:
+            raise RuntimeError("Invalid number of blocks: %i" % n_blocks)
+        count = 1 if n_blocks is None else n_blocks
+
+        # if the service runs in several processes, a stop only means that the process we are
+        # connected to is done; it stops listening, so reconnect until no process is left.
+        # once we were connected, a refused connection means that the service has shut down
+        try:
+            response = super(BlockClient, self).request(count)
+            while response is None:
+                self.close()
+                response = super(BlockClient, self).request(count)
+        except ConnectionRefusedError:
+            if not self._was_connected:
+                raise
+            response = None
+        if response is None or n_blocks is not None:
+            return response
+        return response[0]
+
+    def read_response(self):
+        """
+        Read the response frame, the header is followed by offsets for STATUS_BLOCK.
+        """
+        response = self.receive(0, HEADER.size)
+        status, count = HEADER.unpack(response)
+        if status == STATUS_BLOCK:
+            response = self.receive(HEADER.size, HEADER.size + count * OFFSETS_SIZE)
+        return response
 
     def format_response(self, response):
         """
         Format incoming response.
         """
-        response = response.split()
-        # if the response has length 3, it consists of
+        status = response[0]
+        # if the status is STATUS_BLOCK, the response contains
         # block coordinates
-        if len(response) == 3:
-            return list(map(int, response))
+        if status == STATUS_BLOCK:
+            return unpack_offsets(response)
         else:
-            response = response[0]
-            return None if response is 'stop' else bool(int(response))
+            return _STATUS_RESPONSES[status]
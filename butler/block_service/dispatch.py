@@ -0,0 +1,100 @@
+import numpy as np
+
+# states of the blocks
+PENDING, IN_PROGRESS, DONE, FAILED = 0, 1, 2, 3
+
+
+class BlockDispatcher(object):
+    """
+    Bookkeeping for the blocks handed out by `BlockService`:
+    pending, in-progress, processed and failed blocks.
+    Does not lock or log, this is left to the service.
+    Times are integer nanoseconds of a monotonic clock (`time.monotonic_ns`),
+    `time_limit` is given in seconds.
+    """
+
+    def __init__(self, blocks, time_limit):
+        # the coordinates of the blocks that will be processed (N x 3), their states
+        # and the deadlines of the blocks in progress
+        self.blocks = blocks
+        self.state = np.full(len(blocks), PENDING, dtype='uint8')
+        self.deadline = np.zeros(len(blocks), dtype='int64')
+        self.time_limit = int(time_limit * 1e9)
+        # indices of the blocks that are handed out in order by advancing `head`
+        self.queue = range(len(blocks))
+        self.head = 0
+
+        # mapping of the offsets (as tuple) of the blocks that are currently processed to their index
+        self.in_progress = {}
+
+    def pop_blocks(self, n_blocks, now):
+        """
+        Get up to `n_blocks` pending blocks and add them to the blocks in progress.
+        Returns an empty list if no blocks are pending.
+        """
+        indices = np.asarray(self.queue[self.head:self.head + n_blocks])
+        if not len(indices):
+            return []
+        self.head += len(indices)
+        self.state[indices] = IN_PROGRESS
+        self.deadline[indices] = now + self.time_limit
+        block_offsets = list(map(tuple, self.blocks[indices].tolist()))
+        self.in_progress.update(zip(block_offsets, indices.tolist()))
+        return block_offsets
+
+    def confirm(self, block_offsets):
+        """
+        Mark a block in progress as processed.
+        Returns False if the block is not in progress (anymore).
+        """
+        index = self.in_progress.pop(tuple(block_offsets), None)
+        if index is None:
+            return False
+        self.state[index] = DONE
+        return True
+
+    def sweep(self, now):
+        """
+        Mark the blocks that have exceeded the time limit as failed.
+        Returns the number of failed blocks.
+        """
+        expired = np.flatnonzero((self.state == IN_PROGRESS) & (self.deadline < now))
+        if len(expired):
+            self.state[expired] = FAILED
+            for block_offsets in map(tuple, self.blocks[expired].tolist()):
+                del self.in_progress[block_offsets]
+        return len(expired)
+
+    def next_deadline(self):
+        """
+        Earliest deadline of the blocks in progress, None if there are no blocks in progress.
+        """
+        if not self.in_progress:
+            return None
+        return int(self.deadline[self.state == IN_PROGRESS].min())
+
+    def has_pending(self):
+        """
+        Check if there are pending blocks.
+        """
+        return self.head < len(self.queue)
+
+    def has_failed(self):
+        """
+        Check if there are failed blocks.
+        """
+        return bool((self.state == FAILED).any())
+
+    def repopulate(self):
+        """
+        Queue the failed blocks to be handed out again.
+        """
+        self.queue = np.flatnonzero(self.state == FAILED)
+        self.head = 0
+        self.state[self.queue] = PENDING
+
+    def get_blocks(self, state):
+        """
+        Get the offsets of all blocks in the given state.
+        """
+        return self.blocks[self.state == state]
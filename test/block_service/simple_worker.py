@@ -3,36 +3,39 @@ import time
 from concurrent import futures
 import numpy as np
 
-sys.path.append('/home/papec/Work/my_projects/z5/bld/python')
-# sys.path.append('/home/papec/Work/software/bld/z5/python')
-sys.path.append('../..')
 
-
-def dummy_worker(worker_id):
+def dummy_worker(worker_id, n_blocks=8, write=True):
     import z5py
     from butler.block_service import BlockClient
-    host, port = "localhost", 9999
+    host, port = "127.0.0.1", 9999
     client = BlockClient(host, port)
     out_file = './output.n5'
     block_shape = (100, 100, 100)
-    ds = z5py.File(out_file)['out']
-
-    x = np.ones(block_shape, dtype='uint8')
+    # if the output is prefilled, the blocks are only leased and not written
+    if write:
+        ds = z5py.File(out_file)['out']
+        x = np.ones(block_shape, dtype='uint8')
 
     print("Starting inference, worker", worker_id)
     while True:
-        block_offset = client.request()
-        # print("Processing block", block_offset)
-        if block_offset is None:
+        # lease several blocks per request
+        block_offsets = client.request(n_blocks=n_blocks)
+        if block_offsets is None:
             break
 
-        roi = tuple(slice(bo, bo + bs) for bo, bs in zip(block_offset, block_shape))
-        data = ds[roi]
-        data += x
-        ds[roi] = data
-        # TODO weirdly enough, this is valid code, but I am pretty sure it does not
-        # do what it's supposed to
-        # ds[roi] += x
+        if write:
+            for block_offset in block_offsets:
+                # print("Processing block", block_offset)
+                roi = tuple(slice(bo, bo + bs) for bo, bs in zip(block_offset, block_shape))
+                data = ds[roi]
+                data += x
+                ds[roi] = data
+                # TODO weirdly enough, this is valid code, but I am pretty sure it does not
+                # do what it's supposed to
+                # ds[roi] += x
+
+        # confirm the blocks to the service
+        client.request(block_offsets)
 
     print("Done inference, worker", worker_id)
 
@@ -40,6 +43,9 @@ def dummy_worker(worker_id):
 if __name__ == '__main__':
     t0 = time.time()
     n_workers = int(sys.argv[1])
+    # pass --prefilled if the service was started with --prefill, then the workers only
+    # lease (and confirm) blocks without touching the output
+    write = '--prefilled' not in sys.argv[2:]
     with futures.ProcessPoolExecutor(n_workers) as pp:
-        tasks = [pp.submit(dummy_worker, worker) for worker in range(n_workers)]
+        tasks = [pp.submit(dummy_worker, worker, write=write) for worker in range(n_workers)]
     print("Processing with", n_workers, "workers took", time.time() - t0)
@@ -1,48 +1,99 @@
 import os
-import sys
 import json
+import argparse
 import logging
+import numpy as np
 from shutil import rmtree
 
-sys.path.append('/home/papec/Work/my_projects/z5/bld/python')
-# sys.path.append('/home/papec/Work/software/bld/z5/python')
-sys.path.append('../..')
+# configure logging once on import, basicConfig does nothing if the root logger has handlers already
+logging.basicConfig(level=logging.INFO)
+
+
+# check if the output dataset exists with the expected layout and compression
+# and was not written to yet
+def _dataset_is_valid(path, shape, chunks, compression):
+    import z5py
+    if not os.path.exists(os.path.join(path, 'out')):
+        return False
+    try:
+        ds = z5py.File(path)['out']
+        with open(os.path.join(path, 'out', 'attributes.json')) as f:
+            attrs = json.load(f)
+    except (KeyError, OSError, RuntimeError, ValueError):
+        return False
+    if ds.shape != shape or ds.chunks != chunks:
+        return False
+    # n5 stores the compression as {"type": ...}, older versions as "compressionType"
+    if attrs.get('compression', {}).get('type', attrs.get('compressionType')) != compression:
+        return False
+    # the workers increment the data, so a dataset that has chunks already can't be reused
+    return os.listdir(os.path.join(path, 'out')) == ['attributes.json']
 
 
 # make a dummy block list
-# and output file
-def setup():
+# and output file, if `prefill` is set, the output is filled with the expected result,
+# so that workers started with --prefilled only exercise the service;
+# `reset` recreates the output in any case
+def setup(block_list='./block_list.json', reset=False, prefill=False):
     import z5py
     shape = (1000, 1000, 1000)
     chunks = (100, 100, 100)
+    # the test data is constant and throw-away, so don't pay for gzip when the workers
+    # write and test_output reads it
+    compression = 'raw'
+
+    # only recreate the output dataset if the one from a previous run can't be used
+    if reset or prefill or not _dataset_is_valid('./output.n5', shape, chunks, compression):
+        if os.path.exists('./output.n5'):
+            rmtree('./output.n5')
+
+        f = z5py.File('./output.n5')
+        ds = f.create_dataset('out', shape=shape, chunks=chunks, dtype='uint8', compression=compression)
+        # fill the whole dataset with a single broadcasting write, z5py splits it into chunks
+        if prefill:
+            ds[:] = 1
 
-    if os.path.exists('./output.n5'):
-        rmtree('./output.n5')
+    # the block list never changes, so it is only written if it does not exist yet
+    if os.path.exists(block_list):
+        return
 
-    f = z5py.File('./output.n5')
-    f.create_dataset('out', shape=shape, chunks=chunks, dtype='uint8', compression='gzip')
+    zs, ys, xs = np.mgrid[0:1000:100, 0:1000:100, 0:1000:100]
+    blocks = np.stack([zs.ravel(), ys.ravel(), xs.ravel()], axis=1)
 
-    block_list = []
-    for z in range(10):
-        for y in range(10):
-            for x in range(10):
-                block_list.append([z*100, y*100, x*100])
+    # the service also reads block lists stored as npy
+    if os.path.splitext(block_list)[1] == '.npy':
+        np.save(block_list, blocks.astype('int32'))
+        return
 
-    with open('block_list.json', 'w') as f:
-        json.dump(block_list, f)
+    # the list is regular, so format it in one go and write it at once instead of using json.dump
+    with open(block_list, 'w') as f:
+        f.write('[%s]' % ','.join('[%i,%i,%i]' % tuple(block) for block in blocks.tolist()))
 
 
-def start_service():
+def start_service(block_list='./block_list.json', time_limit=20, check_interval=10,
+                  out_prefix='./service_status_', num_processes=1, reset=False, prefill=False):
     from butler import start_service
     from butler.block_service import BlockService, BlockRequestHandler
-    setup()
-    host, port = "localhost", 9999
-    block_list = './block_list.json'
-    # TODO properly set up logger
-    logging.basicConfig(level=logging.INFO)
-    service = BlockService(block_list, 20, 10, out_prefix='./service_status_')
-    start_service(host, port, service, BlockRequestHandler)
+    setup(block_list, reset, prefill)
+    host, port = "127.0.0.1", 9999
+    service = BlockService(block_list, time_limit, check_interval, out_prefix=out_prefix)
+    start_service(host, port, service, BlockRequestHandler, num_processes=num_processes)
 
 
 if __name__ == '__main__':
-    start_service()
+    parser = argparse.ArgumentParser(description="Start the block service for the test workers")
+    parser.add_argument('--block-list', default='./block_list.json',
+                        help="block list to serve, written by the setup if it does not exist")
+    parser.add_argument('--timeout', type=int, default=20, help="time limit for a block in seconds")
+    parser.add_argument('--check-interval', type=int, default=10,
+                        help="interval for checking the time limit in seconds")
+    parser.add_argument('--out-prefix', default='./service_status_', help="prefix for the status files")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="number of service processes, 0 for one per cpu")
+    parser.add_argument('--reset', action='store_true', help="recreate the output dataset")
+    parser.add_argument('--prefill', action='store_true',
+                        help="fill the output dataset with the expected result, "
+                             "run the workers with --prefilled to skip their writes")
+    args = parser.parse_args()
+    start_service(args.block_list, args.timeout, args.check_interval, args.out_prefix,
+                  args.workers or None, args.reset, args.prefill)
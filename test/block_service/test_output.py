@@ -1,13 +1,21 @@
-import sys
+import itertools
 import numpy as np
-sys.path.append('/home/papec/Work/my_projects/z5/bld/python')
 
 
 def test_output():
     import z5py
-    data = z5py.File('./output.n5')['out'][:]
-    print(np.sum(data), '/', data.size)
-    assert np.allclose(data, 1), "Failed !"
+    ds = z5py.File('./output.n5')['out']
+    # check chunk by chunk, so that the full dataset is never loaded into memory;
+    # the data is uint8, so compare exactly instead of using np.allclose.
+    # counting the matching voxels needs a single pass over each chunk
+    n_matching = 0
+    starts = [range(0, sh, ch) for sh, ch in zip(ds.shape, ds.chunks)]
+    for chunk_offset in itertools.product(*starts):
+        roi = tuple(slice(co, co + ch) for co, ch in zip(chunk_offset, ds.chunks))
+        n_matching += int(np.count_nonzero(ds[roi] == 1))
+    size = int(np.prod(ds.shape))
+    print(n_matching, '/', size)
+    assert n_matching == size, "Failed !"
     print("Passed !")
 
 